@@ -3,9 +3,11 @@ import logging
 import copy
 from datetime import datetime
 from concurrent import futures
+import signal
 import threading
 import time
 import argparse
+import collections
 
 from kubernetes import client as kclient, config, watch
 import urllib3
@@ -15,6 +17,7 @@ from .action import (
     ActionChain,
     VMSSNodeProxy,
     AzureContext,
+    InflightTracker,
     # MarkerAction,
     TainterAction,
     WrappedGeneratorMixin,
@@ -24,42 +27,76 @@ from .action import (
     RunCommandAction,
     ExpBackoff,
 )
+from .action.base import transitions
 from .azclient import AzureClient
+from .executor import FairExecutor
+from .logutils import setup_logging
+from .record import EventRecorder, RecordingAzureClient
 from .utils import jsonpath_escape
 
 
 logger = logging.getLogger('akswinpostinit.main')
 
+# PartialObjectMetadata, falling back to full objects for API servers not supporting it
+METADATA_ONLY_ACCEPT = 'application/json;as=PartialObjectMetadata;g=meta.k8s.io;v=v1,application/json'
+_UNSEEN = object()
+
+
+class ShutdownRequested(BaseException):
+    """raised from the signal handler to break out of the watch loop.
+    BaseException like KeyboardInterrupt, so it doesn't get swallowed by `except Exception`"""
+
 
 class FuturesFollower(threading.Thread):
     def __init__(self):
         super().__init__(name='FuturesFollower', daemon=True)
         self.lock = threading.Lock()
         self.futures = set()
+        self.stopped = threading.Event()
 
     def add_followup(self, f):
         with self.lock:
             self.futures.add(f)
 
+    def report(self, done):
+        for f in done:
+            assert not f.running()
+            if f.cancelled():
+                continue
+
+            try:
+                f.result()
+            except Exception:
+                logger.exception('async run got exception')
+
     def run(self):
-        while True:
+        while not self.stopped.is_set():
             if not self.futures:
                 time.sleep(1)
                 continue
 
             with self.lock:
+                if self.stopped.is_set():
+                    break
+
                 done, self.futures = futures.wait(self.futures,
                     timeout=0, return_when=futures.FIRST_COMPLETED)
 
-            for f in done:
-                assert not f.running()
-                try:
-                    f.result()
-                except Exception:
-                    logger.exception('async run got exception')
-
+            self.report(done)
             time.sleep(1)
 
+    def drain(self, timeout):
+        """take over all followed futures and wait for them, returns futures not done within timeout"""
+        with self.lock:
+            self.stopped.set()
+            pending, self.futures = self.futures, set()
+
+        # cancelled ones never ran, nothing to wait for
+        pending = set(f for f in pending if not f.cancelled())
+        done, not_done = futures.wait(pending, timeout=timeout)
+        self.report(done)
+        return not_done
+
 
 class WinPostInitActionGenerator(WrappedGeneratorMixin, ActionChain):
     def __init__(self, script,
@@ -70,6 +107,8 @@ class WinPostInitActionGenerator(WrappedGeneratorMixin, ActionChain):
             condition_type='AKSWinPostInit',
             taint_key='AKSWinPostInit',
             taint_effect='NoSchedule',
+            runcommand_backoff=None,
+            reboot_backoff=None,
             ):
         taint_template = kclient.V1Taint(
             key=taint_key,
@@ -91,12 +130,12 @@ class WinPostInitActionGenerator(WrappedGeneratorMixin, ActionChain):
         actions.append(RunCommandAction(
             script=script,
             annotation_key=annotation_prefix + runcommand_suffix,
-            backoff=ExpBackoff(120, 1200, 5),
+            backoff=runcommand_backoff or ExpBackoff(120, 1200, 5),
         ))
         if need_reboot:
             actions.append(RebootNodeAction(
                 annotation_key=annotation_prefix + reboot_suffix,
-                backoff=ExpBackoff(300, 3600, 5),
+                backoff=reboot_backoff or ExpBackoff(300, 3600, 5),
             ))
         final_condition_template = kclient.V1NodeCondition(
             type=condition_type,
@@ -110,50 +149,232 @@ class WinPostInitActionGenerator(WrappedGeneratorMixin, ActionChain):
         self.actions = actions
 
 
+class PoolWatcher(threading.Thread):
+    """watches nodes of one node pool, feeding the pool's queue of NodeWatcher"""
+
+    def __init__(self, node_watcher, pool, label_selector):
+        super().__init__(name='PoolWatcher(%s)' % pool, daemon=True)
+        self.node_watcher = node_watcher
+        self.pool = pool
+        self.label_selector = label_selector
+        self.watch = watch.Watch()
+        self.stopped = threading.Event()
+
+    def stop(self):
+        self.stopped.set()
+        self.watch.stop()
+
+    def run(self):
+        try:
+            for node in self.node_watcher.node_events(self.label_selector, self.watch, self.stopped):
+                if self.stopped.is_set():
+                    break
+
+                self.node_watcher.on_node_update(VMSSNodeProxy(node), self.pool)
+        except Exception:
+            if not self.stopped.is_set():
+                logger.exception('watch of pool %s got exception', self.pool)
+
+
 class NodeWatcher(object):
+    """
+    Watches nodes and executes actions on them.
+
+    With pool_label set, node pools are discovered from the label with a
+    metadata only watch, each pool gets its own watch and its own queue
+    limited to pool_max_workers, and workers take actions from the pool queues
+    in round robin. Nodes without the label are grouped as pool None.
+    """
+
     def __init__(self, action_generator, azure_client,
             node_label_selector='kubernetes.io/os=windows',
+            max_workers=4,
+            recorder=None,
+            shutdown_timeout=25,
+            handoff_timeout=5,
+            pool_label=None,
+            pool_max_workers=None,
             ):
         self.node_label_selector = node_label_selector
+        self.recorder = recorder
+        self.shutdown_timeout = shutdown_timeout
+        self.handoff_timeout = handoff_timeout
+        self.pool_label = pool_label
+        self.pool_max_workers = pool_max_workers
+        self.pool_watchers = {}
+        self.stopping = threading.Event()
+        self.inflight = InflightTracker()
         self.triggering_events = frozenset(['ADDED', 'MODIFIED'])
         self.follower = FuturesFollower()
-        self.executor = futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix='action')
+        self.executor = FairExecutor(max_workers=max_workers, thread_name_prefix='action')
+        if not pool_label:
+            self.executor.add_queue(None)
         self.action_generator = action_generator
         self.azure_client = azure_client
-        self.ctx = AzureContext(v1=kclient.CoreV1Api(), azure_client=azure_client)
+        self.ctx = AzureContext(v1=kclient.CoreV1Api(), azure_client=azure_client, inflight=self.inflight)
         self.follower.start()
 
-    def node_events(self):
+    def node_events(self, label_selector=None, w=None, stopped=None):
         v1 = kclient.CoreV1Api()
-        w = watch.Watch()
-        while True:
+        if w is None:
+            w = watch.Watch()
+        while not (stopped and stopped.is_set()):
             try:
                 for event in w.stream(
                         v1.list_node,
-                        label_selector=self.node_label_selector, _request_timeout=120):
+                        label_selector=label_selector or self.node_label_selector, _request_timeout=120):
                     event_type = event['type']
                     node = event['object']
                     node_name = node.metadata.name
-                    logger.debug('event: %s %s', event_type, node_name)
+                    logger.debug('event: %s %s', event_type, node_name, extra={'node': node_name})
+                    if self.recorder:
+                        self.recorder.record_node_event(event_type, node)
                     if event_type in self.triggering_events:
                         yield node
+                    elif event_type == 'DELETED':
+                        transitions.forget(node_name)
             except urllib3.exceptions.ReadTimeoutError as e:
                 logger.debug('ignoring error %s', e)
                 continue
 
-    def loop(self):
-        with self.executor:
-            for node in self.node_events():
-                self.on_node_update(VMSSNodeProxy(node))
+    def install_signal_handlers(self):
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self.on_signal)
+
+    def on_signal(self, signum, frame):
+        if self.stopping.is_set():
+            logger.warning('got signal %d while shutting down, ignoring', signum)
+            return
+
+        self.stopping.set()
+        raise ShutdownRequested(signum)
+
+    def pool_label_selector(self, pool):
+        pool_selector = ('%s=%s' % (self.pool_label, pool)) if pool is not None else ('!' + self.pool_label)
+        if not self.node_label_selector:
+            return pool_selector
+
+        return '%s,%s' % (self.node_label_selector, pool_selector)
+
+    def start_pool_watcher(self, pool):
+        """start watching pool, or restart its watch if it has failed"""
+        watcher = self.pool_watchers.get(pool)
+        if watcher and watcher.is_alive():
+            return
+
+        if watcher:
+            logger.warning('watch of node pool %s stopped, restarting', pool)
+        else:
+            logger.info('found node pool %s, start watching', pool)
+        self.executor.add_queue(pool, self.pool_max_workers)
+        watcher = PoolWatcher(self, pool, self.pool_label_selector(pool))
+        self.pool_watchers[pool] = watcher
+        watcher.start()
+
+    def stop_pool_watcher(self, pool):
+        logger.info('node pool %s is gone, stop watching', pool)
+        self.pool_watchers.pop(pool).stop()
+        self.executor.remove_queue(pool)
+
+    def on_pool_event(self, node_pools, pool_sizes, event_type, node):
+        """
+        keeps node_pools, node name -> pool, and pool_sizes, pool -> node count,
+        up to date, watching a pool from its first node to its last
+        """
+        name = node.metadata.name
+        if event_type == 'DELETED':
+            pool = _UNSEEN
+            old_pool = node_pools.pop(name, _UNSEEN)
+        elif event_type in self.triggering_events:
+            pool = (node.metadata.labels or {}).get(self.pool_label)
+            old_pool = node_pools.get(name, _UNSEEN)
+            node_pools[name] = pool
+            self.start_pool_watcher(pool)
+        else:
+            return
+
+        # the common case, a heartbeat of a node staying in its pool
+        if old_pool == pool:
+            return
+
+        if pool is not _UNSEEN:
+            pool_sizes[pool] += 1
+        if old_pool is not _UNSEEN:
+            pool_sizes[old_pool] -= 1
+            if not pool_sizes[old_pool]:
+                del pool_sizes[old_pool]
+                if old_pool in self.pool_watchers:
+                    self.stop_pool_watcher(old_pool)
+
+    def watch_pools(self):
+        """
+        Discovers node pools from a watch of node metadata only, so that it
+        stays cheap for large clusters, and a new pool gets watched with its
+        first node.
+        """
+        api_client = kclient.ApiClient()
+        # overrides the Accept header of list_node, for all client versions
+        api_client.set_default_header('Accept', METADATA_ONLY_ACCEPT)
+        v1 = kclient.CoreV1Api(api_client)
+        w = watch.Watch()
+        node_pools = {}
+        pool_sizes = collections.Counter()
+        while not self.stopping.is_set():
+            try:
+                for event in w.stream(
+                        v1.list_node,
+                        label_selector=self.node_label_selector, _request_timeout=120):
+                    self.on_pool_event(node_pools, pool_sizes, event['type'], event['object'])
+            except urllib3.exceptions.ReadTimeoutError as e:
+                logger.debug('ignoring error %s', e)
+
+            for pool in list(self.pool_watchers):
+                self.start_pool_watcher(pool)
 
-    def on_node_update(self, node):
+    def loop(self):
+        """watch and act on nodes until shutdown requested, returns if all actions finished in time"""
+        try:
+            if self.pool_label:
+                self.watch_pools()
+            else:
+                for node in self.node_events():
+                    self.on_node_update(VMSSNodeProxy(node))
+        except (ShutdownRequested, KeyboardInterrupt):
+            logger.warning('shutdown requested, stop watching nodes')
+
+        return self.shutdown()
+
+    def shutdown(self):
+        """
+        Cancels queued actions and waits for running ones, then hands off the
+        running retry actions, all within shutdown_timeout. The last
+        handoff_timeout seconds of it are kept for the handoff.
+        Returns True if nothing was left running.
+        """
+        self.stopping.set()
+        for watcher in self.pool_watchers.values():
+            watcher.stop()
+        # queued actions haven't written anything yet, the next controller picks them up as is
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        drain_timeout = max(self.shutdown_timeout - self.handoff_timeout, 0)
+        not_done = self.follower.drain(drain_timeout)
+        if not not_done:
+            logger.warning('all actions finished, shutdown complete')
+            return True
+
+        logger.warning('%d actions still running after %ss, handing off', len(not_done), drain_timeout)
+        self.inflight.handoff(self.ctx.v1, self.handoff_timeout)
+        return False
+
+    def on_node_update(self, node, pool=None):
         """
         Main logic of node update.
         """
         action = self.action_generator.get_action(node)
         if action:
-            logger.info('fireing action %r for %r', action, node)
-            f = self.executor.submit(action.execute, node, self.ctx)
+            logger.info('fireing action %r for %r', action, node, extra={'node': node.metadata.name})
+            # an action still queued for the node gets replaced, it was decided on an older state
+            f = self.executor.submit(pool, node.metadata.name, action.execute, node, self.ctx)
             self.follower.add_followup(f)
 
 
@@ -229,11 +450,37 @@ def main():
     parser.add_argument(
         '--taint-effect', default='NoSchedule',
         help='Effect of taint. Default: "NoSchedule"')
+    parser.add_argument(
+        '--log-format', choices=['text', 'json'], default='text',
+        help='Log output format. Default: "text"')
+    parser.add_argument(
+        '--log-rate-limit', type=float, default=60,
+        help='Seconds to suppress repeated per-node log messages, 0 to disable. Default: 60')
+    parser.add_argument(
+        '--max-workers', type=int, default=4,
+        help='Number of actions executed concurrently. Default: 4')
+    parser.add_argument(
+        '--record',
+        help='Record node events and Azure call latencies to this file, for replay with akswinpostinit.simulate')
+    parser.add_argument(
+        '--shutdown-timeout', type=float, default=25,
+        help='Seconds to shut down on SIGTERM, waiting for running actions then handing off the unfinished ones '
+             'to the next controller. Should be less than terminationGracePeriodSeconds. Default: 25')
+    parser.add_argument(
+        '--handoff-timeout', type=float, default=5,
+        help='Seconds of --shutdown-timeout kept for handing off unfinished actions. Default: 5')
+    parser.add_argument(
+        '--pool-label',
+        help='Node label of node pool, e.g. "agentpool". When set, each node pool is watched and queued separately, '
+             'and workers are shared fairly across pools')
+    parser.add_argument(
+        '--pool-max-workers', type=int,
+        help='With "--pool-label", max number of actions executed concurrently for one node pool. Default: no limit')
 
     args = parser.parse_args()
 
     log_level = {0: logging.WARNING, 1: logging.INFO}.get(args.verbose, logging.DEBUG) 
-    logging.basicConfig(level=log_level)
+    setup_logging(log_level, log_format=args.log_format, rate_limit_interval=args.log_rate_limit)
 
     config.load_config()
     if args.cleanup:
@@ -252,6 +499,11 @@ def main():
         raise parser.error('"--subscription" is required')
 
     azure_client = AzureClient(args.subscription)
+    recorder = None
+    if args.record:
+        recorder = EventRecorder(args.record)
+        azure_client = RecordingAzureClient(azure_client, recorder)
+
     action_generator = WinPostInitActionGenerator(
         script=args.script,
         need_reboot=args.reboot,
@@ -260,9 +512,27 @@ def main():
         taint_key=args.taint_key,
         taint_effect=args.taint_effect,
     )
-    node_watcher = NodeWatcher(action_generator, azure_client)
+    node_watcher = NodeWatcher(action_generator, azure_client,
+        node_label_selector=args.node_selector,
+        max_workers=args.max_workers,
+        recorder=recorder,
+        shutdown_timeout=args.shutdown_timeout,
+        handoff_timeout=args.handoff_timeout,
+        pool_label=args.pool_label,
+        pool_max_workers=args.pool_max_workers,
+    )
+    node_watcher.install_signal_handlers()
     logger.info('all components initiated, starting watch loop')
-    node_watcher.loop()
+    try:
+        finished = node_watcher.loop()
+    finally:
+        if recorder:
+            recorder.close()
+
+    if not finished:
+        # action threads still blocked on Azure calls are FairExecutor's daemon threads,
+        # exiting doesn't wait for them
+        parser.exit(1)
 
 
 def testmain():
@@ -3,4 +3,4 @@ from .marker import ConditionMarkerAction, TainterAction
 from .ready import ReadyAction
 from .rebootnode import RebootNodeAction
 from .runcommand import RunCommandAction
-from .common import VMSSNodeProxy, AzureContext
+from .common import VMSSNodeProxy, AzureContext, InflightTracker
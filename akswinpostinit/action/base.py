@@ -1,7 +1,11 @@
 import logging
 import math
 
+from ..logutils import StateTransitionLogger
+
 logger = logging.getLogger('akswinpostinit.action')
+# evaluation result of each node, only logged when it changes
+transitions = StateTransitionLogger(logger)
 
 
 def backoff_until(min_v, max_v, steps, attempt):
@@ -90,16 +94,18 @@ class ActionChain(ActionGenerator):
 
             current_action = action
 
+        node_name = obj.metadata.name
         if not current_action:
-            logger.info('%r.get_action: full action chain completed', self)
+            transitions.update(node_name, None, '%r.get_action: full action chain completed for %r', self, obj)
             return None
 
-        logger.info('%r.get_action: current action: %r', self, current_action)
         if current_action.is_give_up(obj):
-            logger.info('%r.get_action: action %r currently cannot proceed', self, current_action)
+            transitions.update(node_name, ('give_up', current_action),
+                '%r.get_action: action %r currently cannot proceed for %r', self, current_action, obj)
             return None
 
-        logger.info('%r.get_action: proceed with action %r', self, current_action)
+        transitions.update(node_name, ('proceed', current_action),
+            '%r.get_action: proceed with action %r for %r', self, current_action, obj)
         return current_action
 
 
@@ -114,9 +120,11 @@ class WrappedGeneratorMixin(object):
                 continue
 
             if action.is_give_up(obj):
-                logger.debug('%r.get_action: wrappping action %r is giving up', self, action)
+                transitions.update(obj.metadata.name, ('give_up', action),
+                    '%r.get_action: wrapping action %r is giving up for %r', self, action, obj)
                 return None
 
-            logger.info('%r.get_action: got wrapper action %r', self, action)
+            transitions.update(obj.metadata.name, ('proceed', action),
+                '%r.get_action: got wrapper action %r for %r', self, action, obj)
             return action
         return super().get_action(obj)
@@ -3,20 +3,26 @@ Provides the context structure that's used in the Azure actions.
 """
 
 from collections import namedtuple
-from datetime import datetime
+from datetime import datetime, timezone
+from functools import lru_cache
+import itertools
 import logging
 import json
+import sys
+import threading
+import time
 
 from dateutil.parser import parse
-from dateutil.tz import UTC
 from azure.mgmt.core.tools import parse_resource_id, is_valid_resource_id
 from kubernetes import client as kclient
 
+from ..utils import utcnow
+
 logger = logging.getLogger(__name__)
 
 FIELD_MANAGER = 'akswinpostinit'
 
-AzureContext = namedtuple('AzureContext', ['v1', 'azure_client'])
+AzureContext = namedtuple('AzureContext', ['v1', 'azure_client', 'inflight'], defaults=(None,))
 
 
 def is_resource_detail_vmss(resource_detail):
@@ -49,40 +55,168 @@ class VMSSNodeProxy(object):
             if is_resource_detail_vmss(detail):
                 return detail
 
-        logger.warning('%r.get_resource_detail: node has a unrecognized provider id %s', self, provider_id)
+        logger.warning('%r.get_resource_detail: node has a unrecognized provider id %s', self, provider_id,
+            extra={'node': self.metadata.name})
         return None
 
 
-class DatetimeJsonEncoder(json.JSONEncoder):
-    def default(self, o):
-        if isinstance(o, datetime):
-            return o.isoformat()
+# version 1 (no "v" field) has timestamps in datetime.isoformat(), version 2 has them in fixed RFC 3339 UTC
+ACTION_STATUS_VERSION = 2
+# datetime.fromisoformat only accepts the "Z" suffix since python 3.11
+_FROMISOFORMAT_Z = sys.version_info >= (3, 11)
+# json.dumps builds a new encoder for every call with non default options
+_ENCODER = json.JSONEncoder(separators=(',', ':'))
+
+
+def format_timestamp(dt):
+    """fixed width RFC 3339 in UTC, e.g. '2023-10-19T12:00:00.000000Z'"""
+    dt = dt.astimezone(timezone.utc)
+    # formatting the fields directly is faster than isoformat() and cutting its offset off
+    return '%04d-%02d-%02dT%02d:%02d:%02d.%06dZ' % (
+        dt.year, dt.month, dt.day, dt.hour, dt.minute, dt.second, dt.microsecond)
+
+
+def parse_timestamp(s):
+    """parse timestamp written by format_timestamp"""
+    if not _FROMISOFORMAT_Z and s[-1:] == 'Z':
+        s = s[:-1] + '+00:00'
+    return datetime.fromisoformat(s)
+
+
+def parse_legacy_timestamp(s):
+    """parse timestamp of version 1 annotations, which is datetime.isoformat() in practice"""
+    try:
+        return datetime.fromisoformat(s)
+    except ValueError:
+        return parse(s)
 
-        return super().default(o)
 
+@lru_cache(maxsize=4096)
+def decode_action_status(s):
+    data = json.loads(s)
+    parse_time = parse_timestamp if data.get('v') == ACTION_STATUS_VERSION else parse_legacy_timestamp
+    start_time = data.get('start_time', None) or None
+    if start_time:
+        start_time = parse_time(start_time)
 
-class ActionStatus(namedtuple('ActionStatus', ['start_time', 'success_time', 'attempt'])):
+    success_time = data.get('success_time', None) or None
+    if success_time:
+        success_time = parse_time(success_time)
+
+    attempt = data.get('attempt', 0)
+    handed_off = data.get('handed_off', False)
+    return ActionStatus(start_time, success_time, attempt, handed_off)
+
+
+class ActionStatus(namedtuple('ActionStatus', ['start_time', 'success_time', 'attempt', 'handed_off'],
+                              defaults=(False,))):
+    """Status of a retry action, stored as node annotation.
+
+    Field names stay the same across versions, so controllers of either version
+    can read annotations of the other one during a rolling update.
+    handed_off marks an attempt cut off by a controller shutdown.
+    """
     __slots__ = ()
 
     def to_json(self):
-        return json.dumps(self._asdict(), separators=(',', ':'), cls=DatetimeJsonEncoder)
+        data = {'v': ACTION_STATUS_VERSION}
+        if self.start_time:
+            data['start_time'] = format_timestamp(self.start_time)
+        if self.success_time:
+            data['success_time'] = format_timestamp(self.success_time)
+        data['attempt'] = self.attempt
+        if self.handed_off:
+            data['handed_off'] = True
+        return _ENCODER.encode(data)
 
     @staticmethod
     def from_json(s):
-        data = json.loads(s)
-        start_time = data.get('start_time', None) or None
-        if start_time:
-            start_time = parse(start_time)
+        # same annotation gets parsed for every event of a node and many times per evaluation,
+        # ActionStatus being immutable, decoded results can be shared
+        return decode_action_status(s)
 
-        success_time = data.get('success_time', None) or None
-        if success_time:
-            success_time = parse(success_time)
 
-        attempt = data.get('attempt', 0)
-        return ActionStatus(start_time, success_time, attempt)
+DEFAULT_ACTION_STATUS = ActionStatus(None, None, 0)
 
 
-DEFAULT_ACTION_STATUS = ActionStatus(None, None, 0)
+class InflightTracker(object):
+    """Tracks retry actions that have written their start status but not finished yet.
+
+    On shutdown, handoff marks the status of unfinished attempts as handed off.
+    The Azure operation of such an attempt keeps running after the controller
+    exits, so the attempt is kept and the next controller still backs off, but
+    only as long as for the attempt before it, see RetryMixin.get_attempt.
+
+    For each attempt exactly one of the action and handoff writes the final
+    status: the action claims its token before writing success, and handoff
+    only takes tokens not claimed yet.
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.tokens = itertools.count()
+        self.inflight = {}  # token -> (node_name, annotation_key, ActionStatus of the attempt)
+        self.finishing = set()  # claimed tokens, whose success status is being written
+
+    def __len__(self):
+        with self.cond:
+            return len(self.inflight)
+
+    def begin(self, node_name, annotation_key, status):
+        token = next(self.tokens)
+        with self.cond:
+            self.inflight[token] = (node_name, annotation_key, status)
+        return token
+
+    def claim(self, token):
+        """returns False if the attempt has been handed off, then the action must not write its status"""
+        with self.cond:
+            if token not in self.inflight:
+                return False
+
+            self.finishing.add(token)
+            return True
+
+    def end(self, token):
+        with self.cond:
+            self.inflight.pop(token, None)
+            self.finishing.discard(token)
+            self.cond.notify_all()
+
+    def handoff(self, v1, timeout=5):
+        """
+        Hands off unfinished attempts within timeout seconds: up to half of it
+        waiting for success status being written, the rest patching annotations.
+        """
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            items = [item for token, item in self.inflight.items() if token not in self.finishing]
+            for token in list(self.inflight):
+                if token not in self.finishing:
+                    del self.inflight[token]
+
+            # attempts writing their success status get to finish, so it isn't cut off by exiting
+            finishing_timeout = timeout / 2
+            if not self.cond.wait_for(lambda: not self.finishing, finishing_timeout):
+                logger.warning('%d success status still being written after %ss', len(self.finishing), finishing_timeout)
+
+        for i, (node_name, annotation_key, status) in enumerate(items):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logger.error('no time left handing off, %d attempts left as is', len(items) - i)
+                break
+
+            logger.warning('handing off unfinished %s on node %s', annotation_key, node_name)
+            try:
+                v1.patch_node(node_name, {
+                    'metadata': {
+                        'annotations': {
+                            annotation_key: status._replace(handed_off=True).to_json(),
+                        }
+                    }
+                }, _request_timeout=remaining)
+            except Exception:
+                logger.exception('failed handing off %s on node %s', annotation_key, node_name)
 
 
 class RetryMixin(object):
@@ -107,7 +241,7 @@ class RetryMixin(object):
 
     def get_delta_time_in_seconds(self, node):
         status = self._parse_status(node)
-        now = datetime.now(UTC)
+        now = utcnow()
         if status.start_time is None:
             return None
 
@@ -115,7 +249,8 @@ class RetryMixin(object):
 
     def is_done(self, node):
         if not node.get_resource_detail():
-            logger.info('%r.is_done: skipping non-Azure VMSS node %r', self, node)
+            logger.info('%r.is_done: skipping non-Azure VMSS node %r', self, node,
+                extra={'node': node.metadata.name})
             return True
 
         status = self._parse_status(node)
@@ -123,6 +258,10 @@ class RetryMixin(object):
 
     def get_attempt(self, node):
         status = self._parse_status(node)
+        if status.handed_off:
+            # cut off by a restart rather than failed, back off like the attempt before.
+            # The attempt still counts for the next one.
+            return max(status.attempt - 1, 0)
         return status.attempt
 
     def execute_inner(self, resource_detail, ctx):
@@ -130,10 +269,10 @@ class RetryMixin(object):
 
     def execute(self, node, ctx):
         node_name = node.metadata.name
-        now = datetime.now(UTC)
+        now = utcnow()
         status = self._parse_status(node)
         # increment attempt
-        status = status._replace(attempt=status.attempt + 1, start_time=now)
+        status = status._replace(attempt=status.attempt + 1, start_time=now, handed_off=False)
         ctx.v1.patch_node(node_name, {
             'metadata': {
                 'annotations': {
@@ -141,20 +280,37 @@ class RetryMixin(object):
                 }
             }
         })
-        resource_detail = node.get_resource_detail()
-        if not resource_detail:
-            raise ValueError('Invalid Azure resource detail for node %r: %r' % (node, resource_detail))
-        self.execute_inner(resource_detail, ctx)
-        now = datetime.now(UTC)
-        status = status._replace(success_time=now)
-        # XXX: currently we rely on periodic scan, no need to report any failure.
-        ctx.v1.patch_node(node_name, {
-            'metadata': {
-                'annotations': {
-                    self.annotation_key: status.to_json(),
+        token = ctx.inflight.begin(node_name, self.annotation_key, status) \
+            if ctx.inflight is not None else None
+        try:
+            resource_detail = node.get_resource_detail()
+            if not resource_detail:
+                raise ValueError('Invalid Azure resource detail for node %r: %r' % (node, resource_detail))
+            self.execute_inner(resource_detail, ctx)
+        except BaseException:
+            # a failed attempt keeps its start status, so it backs off as usual
+            if token is not None:
+                ctx.inflight.end(token)
+            raise
+
+        if token is not None and not ctx.inflight.claim(token):
+            logger.warning('%r.execute: attempt on %r finished after being handed off', self, node)
+            return
+
+        try:
+            now = utcnow()
+            status = status._replace(success_time=now)
+            # XXX: currently we rely on periodic scan, no need to report any failure.
+            ctx.v1.patch_node(node_name, {
+                'metadata': {
+                    'annotations': {
+                        self.annotation_key: status.to_json(),
+                    }
                 }
-            }
-        })
+            })
+        finally:
+            if token is not None:
+                ctx.inflight.end(token)
 
 
 
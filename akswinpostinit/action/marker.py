@@ -1,13 +1,11 @@
 import logging
 import copy
-from datetime import datetime
 
 from kubernetes import client as kclient
-from dateutil.tz import UTC
 
 from .base import Action
 from .common import FIELD_MANAGER
-from ..utils import jsonpath_escape
+from ..utils import jsonpath_escape, utcnow
 
 logger = logging.getLogger(__name__)
 
@@ -29,7 +27,7 @@ class ConditionMarkerAction(Action):
 
     def execute(self, node, ctx):
         assert not self.is_done(node)
-        now = datetime.now(UTC)
+        now = utcnow()
         new_condition = copy.copy(self.condition_template)
         new_condition.last_heartbeat_time = now
         new_condition.last_transition_time = now
@@ -63,7 +61,8 @@ class TainterAction(Action):
         """None for no action, True for on and False for off"""
         taint_on = self.is_taint_on(node)
         condition_off = self.is_condition_off(node)
-        logger.debug('%r.decision: node: %r, taint_on: %r, condition_off: %r', self, node, taint_on, condition_off)
+        logger.debug('%r.decision: node: %r, taint_on: %r, condition_off: %r', self, node, taint_on, condition_off,
+            extra={'node': node.metadata.name})
         turn_taint_off = taint_on and condition_off
         turn_taint_on = (not taint_on) and (not condition_off)
         if not (turn_taint_off or turn_taint_on):
@@ -83,7 +82,7 @@ class TainterAction(Action):
         taints = [taint for taint in (node.spec.taints or []) if taint.key != self.taint_template.key]
         if decision: # add taint
             taint = copy.copy(self.taint_template)
-            now = datetime.now(UTC)
+            now = utcnow()
             taint.time_added = now
             taints.append(taint)
 
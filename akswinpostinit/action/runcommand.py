@@ -5,6 +5,7 @@ from dateutil.parser import parse
 
 from .base import Action
 from .common import RetryMixin
+from ..logutils import Truncated
 
 logger = logging.getLogger(__name__)
 
@@ -23,5 +24,8 @@ class RunCommandAction(RetryMixin, Action):
             instance_id=resource_detail['resource_name'], 
             script=self.script)
 
+        # output is only logged in full with debug enabled, otherwise bounded
+        if not logger.isEnabledFor(logging.DEBUG):
+            result_stdout, result_stderr = Truncated(result_stdout), Truncated(result_stderr)
         logger.info('%r.execute_innter: script succeeded with stdout: %r, stderr: %r',
             self, result_stdout, result_stderr)
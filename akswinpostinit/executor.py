@@ -0,0 +1,158 @@
+"""
+Executor that shares worker threads fairly across several task queues.
+"""
+
+from collections import OrderedDict
+from concurrent import futures
+import threading
+
+
+def _cancel(future):
+    # notifying lets futures.wait count it as done, it would wait for it forever otherwise
+    if future.cancel():
+        future.set_running_or_notify_cancel()
+
+
+class _Queue(object):
+    def __init__(self, name, max_concurrency):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.pending = OrderedDict()  # key -> (future, fn, args)
+        self.running = 0
+        # removed but still has running tasks, kept so that its running count stays right
+        self.removed = False
+
+    def is_ready(self):
+        return bool(self.pending) and (self.max_concurrency is None or self.running < self.max_concurrency)
+
+
+class FairExecutor(object):
+    """Executes tasks of named queues with a shared set of worker threads.
+
+    Workers take tasks from the queues in round robin, and each queue can have
+    its own concurrency limit, so a queue with a lot of tasks can't starve the
+    others. Tasks are submitted with a key, a task replaces the one of the same
+    key still waiting in the queue, cancelling its future.
+
+    Mirrors the parts of concurrent.futures.Executor the controller uses.
+    Unlike ThreadPoolExecutor, workers are daemon threads on purpose: on
+    shutdown, NodeWatcher hands off actions still blocked on Azure calls after
+    its deadline, and the process must be able to exit without joining them.
+    """
+
+    def __init__(self, max_workers, thread_name_prefix='worker'):
+        assert max_workers > 0
+        self.cond = threading.Condition()
+        self.queues = OrderedDict()  # name -> _Queue
+        self.next_index = 0
+        self.is_shutdown = False
+        self.threads = []
+        for i in range(max_workers):
+            t = threading.Thread(name='%s_%d' % (thread_name_prefix, i), target=self._work, daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def add_queue(self, name, max_concurrency=None):
+        with self.cond:
+            queue = self.queues.get(name)
+            if queue is None:
+                self.queues[name] = _Queue(name, max_concurrency)
+            elif queue.removed:
+                # came back before its running tasks finished, they still count against the limit
+                queue.removed = False
+                queue.max_concurrency = max_concurrency
+
+    def remove_queue(self, name):
+        """remove the queue and cancel its waiting tasks, running tasks still finish"""
+        with self.cond:
+            queue = self.queues.get(name)
+            if queue is None or queue.removed:
+                return
+
+            cancelled = [future for future, _, _ in queue.pending.values()]
+            queue.pending.clear()
+            if queue.running:
+                queue.removed = True
+            else:
+                del self.queues[name]
+
+        for future in cancelled:
+            _cancel(future)
+
+    def submit(self, queue_name, key, fn, *args):
+        future = futures.Future()
+        with self.cond:
+            if self.is_shutdown:
+                raise RuntimeError('cannot schedule new futures after shutdown')
+
+            queue = self.queues[queue_name]
+            if queue.removed:
+                raise KeyError(queue_name)
+
+            replaced = queue.pending.get(key)
+            # replacing keeps the position in the queue
+            queue.pending[key] = (future, fn, args)
+            self.cond.notify()
+
+        if replaced:
+            _cancel(replaced[0])
+        return future
+
+    def shutdown(self, wait=True, cancel_futures=False):
+        cancelled = []
+        with self.cond:
+            self.is_shutdown = True
+            if cancel_futures:
+                for queue in self.queues.values():
+                    cancelled.extend(future for future, _, _ in queue.pending.values())
+                    queue.pending.clear()
+            self.cond.notify_all()
+
+        for future in cancelled:
+            _cancel(future)
+
+        if wait:
+            for t in self.threads:
+                t.join()
+
+    def _next_task(self):
+        """pick a task from the next ready queue in round robin, called with cond held"""
+        names = list(self.queues)
+        for i in range(len(names)):
+            index = (self.next_index + i) % len(names)
+            queue = self.queues[names[index]]
+            if queue.is_ready():
+                self.next_index = index + 1
+                _, (future, fn, args) = queue.pending.popitem(last=False)
+                queue.running += 1
+                return queue, future, fn, args
+
+        return None
+
+    def _work(self):
+        while True:
+            with self.cond:
+                task = self._next_task()
+                while task is None:
+                    if self.is_shutdown:
+                        return
+
+                    self.cond.wait()
+                    task = self._next_task()
+
+            queue, future, fn, args = task
+            try:
+                if future.set_running_or_notify_cancel():
+                    try:
+                        result = fn(*args)
+                    except BaseException as e:
+                        future.set_exception(e)
+                    else:
+                        future.set_result(result)
+            finally:
+                with self.cond:
+                    queue.running -= 1
+                    if queue.removed and not queue.running:
+                        del self.queues[queue.name]
+                    # the queue may have been waiting on its concurrency limit
+                    self.cond.notify_all()
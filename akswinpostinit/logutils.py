@@ -0,0 +1,185 @@
+"""
+Logging helpers for the controller hot path.
+
+Node events arrive at heartbeat rate, so most evaluations end up with the same
+result as the previous one. The helpers here keep the per-event cost low:
+
+- StateTransitionLogger only logs when the evaluated state of a node changes.
+- NodeRateLimitFilter drops repeated per-node messages within an interval.
+- %-style arguments are only formatted when a record is emitted, Truncated
+  keeps that for large strings and bounds their size.
+- JsonFormatter writes one JSON object per record.
+"""
+
+from datetime import datetime, timezone
+import json
+import logging
+import threading
+
+DEFAULT_TRUNCATE_LIMIT = 1024
+# state of a key not logged yet, None being a valid state
+_UNSEEN = object()
+
+
+class Truncated(object):
+    """Lazily truncate a potentially large string, e.g. run command output.
+
+    'a' * 2000 --> 'aaa...' + '...(1000 more chars)'
+    """
+    __slots__ = ('s', 'limit')
+
+    def __init__(self, s, limit=DEFAULT_TRUNCATE_LIMIT):
+        self.s = s
+        self.limit = limit
+
+    def __str__(self):
+        s = self.s or ''
+        if len(s) <= self.limit:
+            return s
+
+        return '%s...(%d more chars)' % (s[:self.limit], len(s) - self.limit)
+
+    def __repr__(self):
+        return repr(str(self))
+
+
+class StateTransitionLogger(object):
+    """Logs a message for a key only when its state differs from the last logged one.
+
+    Thread safe, as actions are evaluated from watch threads.
+    """
+
+    def __init__(self, logger, level=logging.INFO):
+        self.logger = logger
+        self.level = level
+        self.lock = threading.Lock()
+        self.states = {}
+
+    def update(self, key, state, msg, *args):
+        """record state for key, log msg if it is a transition. Returns True if logged"""
+        with self.lock:
+            if self.states.get(key, _UNSEEN) == state:
+                return False
+
+            self.states[key] = state
+
+        if self.logger.isEnabledFor(self.level):
+            self.logger.log(self.level, msg, *args, extra={'node': key, 'transition': True})
+        return True
+
+    def forget(self, key):
+        with self.lock:
+            self.states.pop(key, None)
+
+
+class NodeRateLimitFilter(logging.Filter):
+    """Deduplicate and rate limit log records carrying a `node` extra field.
+
+    Records of the same node and rendered message are let through at most once
+    per interval. The count of dropped records is attached to the next record
+    let through as the `suppressed` field. Records without `node` always pass,
+    so do the ones from StateTransitionLogger, which are already deduplicated.
+    Records let through carry their rendered message as msg, without args.
+    """
+
+    def __init__(self, interval=60, max_keys=100000):
+        super().__init__()
+        self.interval = interval
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+        self.seen = {}  # (node, logger name, message) -> [last emit time, suppressed count]
+
+    def filter(self, record):
+        node = getattr(record, 'node', None)
+        if node is None or getattr(record, 'transition', False):
+            return True
+
+        # rendered message, as one format string covers e.g. every action fired on the node.
+        # Like QueueHandler.prepare, the record keeps the rendered message so formatters don't render again
+        message = record.getMessage()
+        record.msg = message
+        record.args = None
+        key = (node, record.name, message)
+        now = record.created
+        with self.lock:
+            entry = self.seen.get(key)
+            if entry is not None and now - entry[0] < self.interval:
+                entry[1] += 1
+                return False
+
+            if entry is None and len(self.seen) >= self.max_keys:
+                self._expire(now)
+
+            suppressed = entry[1] if entry is not None else 0
+            self.seen[key] = [now, 0]
+
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+    def _expire(self, now):
+        expired = [k for k, (t, _) in self.seen.items() if now - t >= self.interval]
+        for k in expired:
+            del self.seen[k]
+
+        if len(self.seen) >= self.max_keys:
+            self.seen.clear()
+
+
+# attributes of a plain LogRecord, anything else is an extra field
+_RECORD_ATTRS = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """Format records as a single line JSON object.
+
+    Extra fields are included.
+    """
+
+    def format(self, record):
+        data = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        for k, v in record.__dict__.items():
+            if k in _RECORD_ATTRS or k.startswith('_'):
+                continue
+
+            data[k] = v
+
+        if record.exc_info:
+            data['exc_info'] = self.formatException(record.exc_info)
+
+        if record.stack_info:
+            data['stack_info'] = self.formatStack(record.stack_info)
+
+        return json.dumps(data, separators=(',', ':'), default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """logging.BASIC_FORMAT, with the suppressed count appended when present"""
+
+    def __init__(self):
+        super().__init__(logging.BASIC_FORMAT)
+
+    def format(self, record):
+        s = super().format(record)
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            s += ' (%d similar messages suppressed)' % suppressed
+        return s
+
+
+def setup_logging(level, log_format='text', rate_limit_interval=60):
+    """configure root logger for the controller, replaces logging.basicConfig"""
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter() if log_format == 'json' else TextFormatter())
+    if rate_limit_interval and rate_limit_interval > 0:
+        handler.addFilter(NodeRateLimitFilter(interval=rate_limit_interval))
+
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level)
@@ -0,0 +1,160 @@
+"""
+Records the node event stream and Azure call latencies of a running controller.
+
+The record is a gzipped JSON lines file, consumed by akswinpostinit.simulate.
+The first line is a header, every following line is an event, with `t` being
+seconds since the header's `start`:
+
+    {"k":"header","version":1,"start":1697712000.0}
+    {"t":0.012,"k":"node","e":"ADDED","o":{...V1Node...}}
+    {"t":35.2,"k":"azure","op":"run_powershell_script","l":30.1,"ok":true}
+"""
+
+import gzip
+import json
+import logging
+import threading
+import time
+
+from kubernetes import client as kclient, watch
+
+logger = logging.getLogger(__name__)
+
+RECORD_VERSION = 1
+
+# fields that are large and irrelevant to the controller, dropped to keep the record compact
+_DROPPED_METADATA = ('managedFields',)
+_DROPPED_STATUS = ('images',)
+
+
+def _compact_node(node_dict):
+    metadata = node_dict.get('metadata') or {}
+    for key in _DROPPED_METADATA:
+        metadata.pop(key, None)
+
+    status = node_dict.get('status') or {}
+    for key in _DROPPED_STATUS:
+        status.pop(key, None)
+
+    return node_dict
+
+
+class EventRecorder(object):
+    def __init__(self, path, flush_interval=1):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.api_client = kclient.ApiClient()
+        self.f = gzip.open(path, 'wt')
+        self.start = time.time()
+        self.start_monotonic = time.monotonic()
+        self.last_flush = self.start_monotonic
+        self._write({'k': 'header', 'version': RECORD_VERSION, 'start': self.start})
+
+    def _write(self, data):
+        line = json.dumps(data, separators=(',', ':'))
+        with self.lock:
+            if self.f is None:
+                return
+
+            self.f.write(line)
+            self.f.write('\n')
+            now = time.monotonic()
+            if now - self.last_flush >= self.flush_interval:
+                self.f.flush()
+                self.last_flush = now
+
+    def _offset(self):
+        return round(time.monotonic() - self.start_monotonic, 3)
+
+    def record_node_event(self, event_type, node):
+        node_dict = _compact_node(self.api_client.sanitize_for_serialization(node))
+        self._write({'t': self._offset(), 'k': 'node', 'e': event_type, 'o': node_dict})
+
+    def record_azure_call(self, op, latency, ok):
+        self._write({'t': self._offset(), 'k': 'azure', 'op': op, 'l': round(latency, 3), 'ok': ok})
+
+    def close(self):
+        with self.lock:
+            if self.f is not None:
+                self.f.close()
+                self.f = None
+
+
+class RecordingAzureClient(object):
+    """Wraps AzureClient, recording latency and outcome of each call"""
+
+    def __init__(self, azure_client, recorder):
+        self.azure_client = azure_client
+        self.recorder = recorder
+
+    def _call(self, op, *args, **kwargs):
+        start = time.monotonic()
+        ok = False
+        try:
+            result = getattr(self.azure_client, op)(*args, **kwargs)
+            ok = True
+            return result
+        finally:
+            self.recorder.record_azure_call(op, time.monotonic() - start, ok)
+
+    def reboot(self, resource_group, vmss_name, instance_id):
+        return self._call('reboot', resource_group, vmss_name, instance_id)
+
+    def run_powershell_script(self, resource_group, vmss_name, instance_id, script):
+        return self._call('run_powershell_script', resource_group, vmss_name, instance_id, script)
+
+
+class Record(object):
+    """Loaded record. node_events is a list of (t, event_type, V1Node),
+    azure_calls maps op to a list of (latency, ok)"""
+
+    def __init__(self, start, node_events, azure_calls):
+        self.start = start
+        self.node_events = node_events
+        self.azure_calls = azure_calls
+
+    @property
+    def duration(self):
+        return self.node_events[-1][0] if self.node_events else 0
+
+
+def load_record(path):
+    # Watch.unmarshal_event is the stable way across client versions to get a model from json
+    w = watch.Watch()
+    start = None
+    node_events = []
+    azure_calls = {}
+    with gzip.open(path, 'rt') as f:
+        try:
+            for i, line in enumerate(f):
+                line = line.strip()
+                if not line:
+                    continue
+
+                try:
+                    data = json.loads(line)
+                except ValueError:
+                    # most likely the tail of a record that was not closed properly
+                    logger.warning('load_record: skipping malformed line %d of %s', i + 1, path)
+                    continue
+
+                kind = data.get('k')
+                if kind == 'header':
+                    if data.get('version') != RECORD_VERSION:
+                        raise ValueError('unsupported record version %r in %s' % (data.get('version'), path))
+                    start = data['start']
+                elif kind == 'node':
+                    event = w.unmarshal_event(json.dumps({'type': data['e'], 'object': data['o']}), 'V1Node')
+                    node_events.append((data['t'], data['e'], event['object']))
+                elif kind == 'azure':
+                    azure_calls.setdefault(data['op'], []).append((data['l'], data['ok']))
+        except EOFError:
+            # controller got killed before closing the record
+            logger.warning('load_record: %s is truncated, using events read so far', path)
+
+    if start is None:
+        raise ValueError('no header found in %s' % path)
+
+    node_events.sort(key=lambda e: e[0])
+    return Record(start, node_events, azure_calls)
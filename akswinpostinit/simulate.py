@@ -0,0 +1,472 @@
+"""
+Replays a record made with `--record` through WinPostInitActionGenerator on a
+simulated clock, to predict time-to-initialized and worker utilization for
+different worker counts and backoff settings.
+
+    python -m akswinpostinit.simulate record.jsonl.gz --workers 4 8 16 \\
+        --runcommand-backoff 120:1200:5 60:600:5
+
+The simulation replaces the Kubernetes API and Azure client:
+
+- Recorded node events are replayed at their recorded time. Fields owned by the
+  controller (annotations, taint and condition) are taken from the simulated
+  state instead of the record.
+- Patches done by actions take effect at the simulated time they are made, and
+  trigger an evaluation of the node, just like the MODIFIED event the watch
+  would deliver.
+- Azure calls take a latency sampled from the recorded ones for the same
+  operation, and fail if the sampled call failed.
+- Actions queue in FIFO order for a fixed number of workers, and an action
+  still queued for a node is replaced by a newer one, same as the controller's
+  executor without "--pool-label". Per pool queues are not simulated.
+
+Node readiness is taken from the record as is, so the NotReady period of a
+reboot is only reflected as much as the recorded run had it.
+"""
+
+import argparse
+import copy
+from datetime import datetime
+from collections import OrderedDict
+import heapq
+import itertools
+import logging
+import math
+import random
+
+from dateutil.tz import UTC
+
+from .__main__ import WinPostInitActionGenerator
+from .action import AzureContext, ExpBackoff, VMSSNodeProxy
+from .record import load_record
+from .utils import set_utcnow
+
+logger = logging.getLogger('akswinpostinit.simulate')
+
+DEFAULT_LATENCY = {
+    'run_powershell_script': 60,
+    'reboot': 120,
+}
+
+
+class SimulatedAzureError(Exception):
+    pass
+
+
+class SimClock(object):
+    def __init__(self, t):
+        self.t = t
+
+    def utcnow(self):
+        return datetime.fromtimestamp(self.t, UTC)
+
+
+def apply_patch(node, body):
+    """returns a patched copy of node, supports the patches actions make.
+
+    Nodes are never modified in place, so only the changed parts are copied.
+    """
+    node = copy.copy(node)
+    annotations = (body.get('metadata') or {}).get('annotations')
+    if annotations:
+        merged = dict(node.metadata.annotations or {})
+        merged.update(annotations)
+        node.metadata = copy.copy(node.metadata)
+        node.metadata.annotations = merged
+
+    spec = body.get('spec') or {}
+    if 'taints' in spec:
+        node.spec = copy.copy(node.spec)
+        node.spec.taints = list(spec['taints']) or None
+
+    conditions = (body.get('status') or {}).get('conditions')
+    if conditions:
+        types = set(condition.type for condition in conditions)
+        node.status = copy.copy(node.status)
+        node.status.conditions = [
+            condition for condition in (node.status.conditions or [])
+            if condition.type not in types] + list(conditions)
+
+    return node
+
+
+class SimKubeApi(object):
+    """Stand in of CoreV1Api for actions.
+
+    Patches are applied to a working copy visible to the executing action right
+    away, and committed to the simulated cluster at the simulated time they are made.
+    """
+
+    def __init__(self, sim):
+        self.sim = sim
+        self.working = {}
+
+    def _patch(self, name, body):
+        node = self.working.get(name) or self.sim.nodes[name]
+        node = apply_patch(node, body)
+        self.working[name] = node
+        self.sim.schedule(self.sim.clock.t, 'commit', (name, body))
+        return node
+
+    def patch_node(self, name, body, **kwargs):
+        return self._patch(name, body)
+
+    def patch_node_status(self, name, body, **kwargs):
+        return self._patch(name, body)
+
+
+class SimAzureClient(object):
+    def __init__(self, sim, azure_calls, default_latency=DEFAULT_LATENCY):
+        self.sim = sim
+        self.azure_calls = azure_calls
+        self.default_latency = default_latency
+
+    def _call(self, op):
+        samples = self.azure_calls.get(op)
+        if samples:
+            latency, ok = self.sim.random.choice(samples)
+        else:
+            latency, ok = self.default_latency[op], True
+
+        self.sim.clock.t += latency
+        if not ok:
+            raise SimulatedAzureError('simulated %s failure' % op)
+
+    def reboot(self, resource_group, vmss_name, instance_id):
+        self._call('reboot')
+
+    def run_powershell_script(self, resource_group, vmss_name, instance_id, script):
+        self._call('run_powershell_script')
+        return '', ''
+
+
+class SimResult(object):
+    def __init__(self, workers, runcommand_backoff, reboot_backoff,
+                 durations, pending, busy_time, makespan, failures):
+        self.workers = workers
+        self.runcommand_backoff = runcommand_backoff
+        self.reboot_backoff = reboot_backoff
+        self.durations = sorted(durations)
+        self.pending = pending
+        self.busy_time = busy_time
+        self.makespan = makespan
+        self.failures = failures
+
+    def percentile(self, p):
+        """nearest rank percentile of time-to-initialized in seconds, None if no node initialized"""
+        if not self.durations:
+            return None
+
+        rank = math.ceil(p / 100 * len(self.durations)) - 1
+        return self.durations[max(0, min(len(self.durations) - 1, rank))]
+
+    @property
+    def utilization(self):
+        if not self.makespan:
+            return 0
+        return self.busy_time / (self.workers * self.makespan)
+
+
+class Simulator(object):
+    def __init__(self, record, action_generator, workers,
+                 annotation_prefix='github.com.tdihp.akswinpostinit/',
+                 condition_type='AKSWinPostInit',
+                 taint_key='AKSWinPostInit',
+                 resync_interval=60,
+                 horizon=6 * 3600,
+                 seed=0,
+                 ):
+        self.record = record
+        self.action_generator = action_generator
+        self.workers = workers
+        self.annotation_prefix = annotation_prefix
+        self.condition_type = condition_type
+        self.taint_key = taint_key
+        self.resync_interval = resync_interval
+        self.horizon = horizon
+        self.random = random.Random(seed)
+        self.clock = SimClock(record.start)
+        self.queue = []  # heap of (t, seq, kind, payload)
+        self.seq = itertools.count()
+        self.nodes = {}
+        self.first_seen = {}
+        self.initialized_at = {}
+        self.preexisting = set()
+        self.backlog = OrderedDict()  # node name -> (action, node)
+        self.idle_workers = workers
+        self.busy_time = 0
+        self.failures = 0
+        self.api = SimKubeApi(self)
+        self.ctx = AzureContext(v1=self.api, azure_client=SimAzureClient(self, record.azure_calls))
+
+    def schedule(self, t, kind, payload=None):
+        heapq.heappush(self.queue, (t, next(self.seq), kind, payload))
+
+    def is_initialized(self, node):
+        return any(
+            condition.type == self.condition_type and condition.status == 'True'
+            for condition in (node.status.conditions or []))
+
+    def _is_owned_annotation(self, key):
+        return key.startswith(self.annotation_prefix)
+
+    def _overlay(self, recorded, current):
+        """replace the controller owned fields of recorded node with ones of current"""
+        # records are shared between simulations, copy before modifying
+        node = copy.copy(recorded)
+        node.metadata = copy.copy(node.metadata)
+        node.spec = copy.copy(node.spec)
+        node.status = copy.copy(node.status)
+        annotations = {k: v for k, v in (node.metadata.annotations or {}).items()
+                       if not self._is_owned_annotation(k)}
+        taints = [taint for taint in (node.spec.taints or []) if taint.key != self.taint_key]
+        conditions = [condition for condition in (node.status.conditions or [])
+                      if condition.type != self.condition_type]
+        if current is not None:
+            annotations.update((k, v) for k, v in (current.metadata.annotations or {}).items()
+                               if self._is_owned_annotation(k))
+            taints.extend(taint for taint in (current.spec.taints or []) if taint.key == self.taint_key)
+            conditions.extend(condition for condition in (current.status.conditions or [])
+                              if condition.type == self.condition_type)
+
+        node.metadata.annotations = annotations
+        node.spec.taints = taints or None
+        node.status.conditions = conditions
+        return node
+
+    def on_node_event(self, event_type, recorded):
+        name = recorded.metadata.name
+        if event_type == 'DELETED':
+            self.nodes.pop(name, None)
+            self.first_seen.pop(name, None)
+            self.initialized_at.pop(name, None)
+            return
+
+        if event_type not in ('ADDED', 'MODIFIED'):
+            return
+
+        if name not in self.nodes and name not in self.first_seen:
+            self.first_seen[name] = self.clock.t
+            if self.is_initialized(recorded):
+                # initialized before the record started, keep what the real controller did
+                self.preexisting.add(name)
+                self.nodes[name] = recorded
+                return
+
+        self.nodes[name] = self._overlay(recorded, self.nodes.get(name))
+        self.evaluate(name)
+
+    def on_commit(self, name, body):
+        if name not in self.nodes:
+            return
+
+        self.nodes[name] = apply_patch(self.nodes[name], body)
+        if name not in self.initialized_at and self.is_initialized(self.nodes[name]):
+            self.initialized_at[name] = self.clock.t
+        self.evaluate(name)
+
+    def evaluate(self, name):
+        node = VMSSNodeProxy(self.nodes[name])
+        action = self.action_generator.get_action(node)
+        if action:
+            self.backlog[name] = (action, node)
+            self.dispatch()
+
+    def dispatch(self):
+        while self.idle_workers and self.backlog:
+            _, (action, node) = self.backlog.popitem(last=False)
+            self.idle_workers -= 1
+            self.run(action, node)
+
+    def run(self, action, node):
+        """executes action synchronously, Azure calls move the clock forward"""
+        start = self.clock.t
+        self.api.working = {}
+        try:
+            action.execute(node, self.ctx)
+        except Exception as e:
+            logger.debug('simulated action %r for %r failed: %s', action, node, e)
+            self.failures += 1
+
+        end = self.clock.t
+        self.clock.t = start
+        self.busy_time += end - start
+        self.schedule(end, 'done')
+
+    def pending_nodes(self):
+        return [name for name in self.nodes
+                if name not in self.initialized_at and name not in self.preexisting]
+
+    def run_simulation(self):
+        for t, event_type, node in self.record.node_events:
+            self.schedule(self.record.start + t, 'node', (event_type, node))
+
+        end_of_record = self.record.start + self.record.duration
+        deadline = end_of_record + self.horizon
+        if self.resync_interval:
+            # recorded events already carry the heartbeats within the record
+            self.schedule(end_of_record + self.resync_interval, 'resync')
+
+        set_utcnow(self.clock.utcnow)
+        try:
+            while self.queue:
+                t, _, kind, payload = heapq.heappop(self.queue)
+                if t > deadline:
+                    break
+
+                self.clock.t = t
+                if kind == 'node':
+                    self.on_node_event(*payload)
+                elif kind == 'commit':
+                    self.on_commit(*payload)
+                elif kind == 'done':
+                    self.idle_workers += 1
+                    self.dispatch()
+                elif kind == 'resync':
+                    pending = self.pending_nodes()
+                    for name in pending:
+                        self.evaluate(name)
+                    if pending:
+                        self.schedule(t + self.resync_interval, 'resync')
+        finally:
+            set_utcnow(None)
+
+    def durations(self):
+        return [self.initialized_at[name] - self.first_seen[name] for name in self.initialized_at]
+
+
+def parse_backoff(s):
+    """'120:1200:5' --> ExpBackoff(120, 1200, 5)"""
+    try:
+        min_v, max_v, steps = s.split(':')
+        return ExpBackoff(float(min_v), float(max_v), int(steps))
+    except (ValueError, AssertionError):
+        raise argparse.ArgumentTypeError('expecting backoff as min:max:steps, got %r' % s)
+
+
+def format_backoff(backoff):
+    return '%g:%g:%d' % (backoff.min_v, backoff.max_v, backoff.steps)
+
+
+def simulate(record, workers_list, runcommand_backoffs, reboot_backoffs,
+             need_reboot=True,
+             annotation_prefix='github.com.tdihp.akswinpostinit/',
+             condition_type='AKSWinPostInit',
+             taint_key='AKSWinPostInit',
+             **kwargs):
+    """run the simulation for each combination of settings, returns a list of SimResult"""
+    results = []
+    for workers, runcommand_backoff, reboot_backoff in itertools.product(
+            workers_list, runcommand_backoffs, reboot_backoffs):
+        action_generator = WinPostInitActionGenerator(
+            script='',
+            need_reboot=need_reboot,
+            annotation_prefix=annotation_prefix,
+            condition_type=condition_type,
+            taint_key=taint_key,
+            runcommand_backoff=runcommand_backoff,
+            reboot_backoff=reboot_backoff,
+        )
+        sim = Simulator(record, action_generator, workers,
+            annotation_prefix=annotation_prefix,
+            condition_type=condition_type,
+            taint_key=taint_key,
+            **kwargs)
+        sim.run_simulation()
+        results.append(SimResult(
+            workers=workers,
+            runcommand_backoff=runcommand_backoff,
+            reboot_backoff=reboot_backoff,
+            durations=sim.durations(),
+            pending=len(sim.pending_nodes()),
+            busy_time=sim.busy_time,
+            makespan=sim.clock.t - record.start,
+            failures=sim.failures,
+        ))
+
+    return results
+
+
+def format_results(results):
+    header = ('workers', 'runcommand', 'reboot', 'done', 'pending', 'failures',
+              'p50(s)', 'p90(s)', 'p99(s)', 'max(s)', 'util')
+    rows = [header]
+    for r in results:
+        rows.append((
+            str(r.workers),
+            format_backoff(r.runcommand_backoff),
+            format_backoff(r.reboot_backoff),
+            str(len(r.durations)),
+            str(r.pending),
+            str(r.failures),
+        ) + tuple(
+            '-' if r.percentile(p) is None else '%.0f' % r.percentile(p)
+            for p in (50, 90, 99, 100)
+        ) + ('%.1f%%' % (r.utilization * 100),))
+
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    return '\n'.join('  '.join(cell.rjust(width) for cell, width in zip(row, widths)) for row in rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a recorded node event stream on a simulated clock')
+    parser.add_argument(
+        'record',
+        help='Record file written by the controller with "--record"')
+    parser.add_argument(
+        '-v', '--verbose', action='count', default=0,
+        help='Increase verbosity. WARNING --> INFO --> DEBUG')
+    parser.add_argument(
+        '--workers', type=int, nargs='+', default=[4],
+        help='Worker counts to simulate. Default: 4')
+    parser.add_argument(
+        '--runcommand-backoff', type=parse_backoff, nargs='+', default=[ExpBackoff(120, 1200, 5)],
+        help='Run command backoffs to simulate, as min:max:steps. Default: 120:1200:5')
+    parser.add_argument(
+        '--reboot-backoff', type=parse_backoff, nargs='+', default=[ExpBackoff(300, 3600, 5)],
+        help='Reboot backoffs to simulate, as min:max:steps. Default: 300:3600:5')
+    parser.add_argument(
+        '--no-reboot', dest='reboot', action='store_false',
+        help='Simulate without the reboot action')
+    parser.add_argument(
+        '--annotation-prefix', default='github.com.tdihp.akswinpostinit/',
+        help='Annotation prefix the recorded controller used. Default: "github.com.tdihp.akswinpostinit/"')
+    parser.add_argument(
+        '--condition-type', default='AKSWinPostInit',
+        help='Node condition type the recorded controller used. Default: "AKSWinPostInit"')
+    parser.add_argument(
+        '--taint-key', default='AKSWinPostInit',
+        help='Taint key the recorded controller used. Default: "AKSWinPostInit"')
+    parser.add_argument(
+        '--resync-interval', type=float, default=60,
+        help='Seconds between re-evaluations of uninitialized nodes after the record ends, '
+             'standing in for node heartbeats. 0 to only use recorded events. Default: 60')
+    parser.add_argument(
+        '--horizon', type=float, default=6 * 3600,
+        help='Seconds to keep simulating after the end of the record. Default: 21600')
+    parser.add_argument(
+        '--seed', type=int, default=0,
+        help='Random seed for sampling Azure call latencies. Default: 0')
+    args = parser.parse_args()
+
+    log_level = {0: logging.WARNING, 1: logging.INFO}.get(args.verbose, logging.DEBUG)
+    logging.basicConfig(level=log_level)
+
+    record = load_record(args.record)
+    logger.info('loaded %d node events, %d Azure calls over %.0fs',
+        len(record.node_events), sum(len(v) for v in record.azure_calls.values()), record.duration)
+    results = simulate(
+        record, args.workers, args.runcommand_backoff, args.reboot_backoff,
+        need_reboot=args.reboot,
+        annotation_prefix=args.annotation_prefix,
+        condition_type=args.condition_type,
+        taint_key=args.taint_key,
+        resync_interval=args.resync_interval,
+        horizon=args.horizon,
+        seed=args.seed,
+    )
+    print(format_results(results))
+
+
+if __name__ == '__main__':
+    main()
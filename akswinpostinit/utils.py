@@ -1,3 +1,7 @@
+from datetime import datetime
+
+from dateutil.tz import UTC
+
 JSONPATH_TRANSLATE_TABLE = str.maketrans({'~': '~0', '/': '~1'})
 
 
@@ -7,3 +11,21 @@ def jsonpath_escape(s):
     'foo/bar~' --> 'foo~1bar~0'
     """
     return s.translate(JSONPATH_TRANSLATE_TABLE)
+
+
+def _system_utcnow():
+    return datetime.now(UTC)
+
+
+_utcnow = _system_utcnow
+
+
+def utcnow():
+    """current time in UTC. Actions get time from here so that simulation can drive the clock"""
+    return _utcnow()
+
+
+def set_utcnow(func):
+    """replace the clock used by utcnow, None restores the system clock"""
+    global _utcnow
+    _utcnow = func or _system_utcnow